@@ -113,7 +113,8 @@ class RadiomicsFeaturesBase(object):
 
   def _applyBinning(self, matrix):
     matrix, _ = imageoperations.binImage(matrix, self.maskArray, **self.settings)
-    self.coefficients['grayLevels'] = numpy.unique(matrix[self.maskArray])
+    # matrix contains the (non-negative) bin indices, so the gray levels present are found by counting instead of sorting
+    self.coefficients['grayLevels'] = numpy.flatnonzero(numpy.bincount(matrix[self.maskArray]))
     self.coefficients['Ng'] = int(numpy.max(self.coefficients['grayLevels']))  # max gray level in the ROI
     return matrix
 
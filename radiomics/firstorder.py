@@ -72,8 +72,10 @@ class RadiomicsFirstOrder(base.RadiomicsFeaturesBase):
 
     if voxelCoordinates is None:
       self.targetVoxelArray = self.imageArray[self.maskArray].astype('float').reshape((1, -1))
-      _, p_i = numpy.unique(self.discretizedImageArray[self.maskArray], return_counts=True)
-      p_i = p_i.reshape((1, -1))
+      # Discretized gray levels are non-negative integers, so the histogram is obtained by counting (instead of sorting
+      # in numpy.unique). Only the counts of gray levels present in the ROI are retained.
+      p_i = numpy.bincount(self.discretizedImageArray[self.maskArray])
+      p_i = p_i[p_i > 0].reshape((1, -1))
     else:
       # voxelCoordinates shape (Nd, Nvox)
       voxelCoordinates = voxelCoordinates.copy() + self.settings.get('kernelRadius', 1)  # adjust for padding
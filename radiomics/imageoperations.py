@@ -1,5 +1,8 @@
 from __future__ import print_function
 
+import collections
+import concurrent.futures
+import itertools
 import logging
 
 import numpy
@@ -41,8 +44,10 @@ def getMask(mask, **kwargs):
     selector.SetIndex(label_channel)
     mask = selector.Execute(mask)
 
-  logger.debug('Force casting mask to UInt32 to ensure correct datatype.')
-  mask = sitk.Cast(mask, sitk.sitkUInt32)
+  if mask.GetPixelID() != sitk.sitkUInt32:
+    # Casting always generates a new image, so skip it if the mask already has the correct datatype
+    logger.debug('Force casting mask to UInt32 to ensure correct datatype.')
+    mask = sitk.Cast(mask, sitk.sitkUInt32)
 
   labels = numpy.unique(sitk.GetArrayFromImage(mask))
   if len(labels) == 1 and labels[0] == 0:
@@ -113,8 +118,8 @@ def getBinEdges(parameterValues, **kwargs):
     binEdges = numpy.histogram(parameterValues, binCount)[1]
     binEdges[-1] += 1  # Ensures that the maximum value is included in the topmost bin when using numpy.digitize
   else:
-    minimum = min(parameterValues)
-    maximum = max(parameterValues)
+    minimum = numpy.min(parameterValues)
+    maximum = numpy.max(parameterValues)
 
     # Start binning form the first value lesser than or equal to the minimum value and evenly dividable by binwidth
     lowBound = minimum - (minimum % binWidth)
@@ -149,15 +154,38 @@ def binImage(parameterMatrix, parameterMatrixCoordinates=None, **kwargs):
 
   discretizedParameterMatrix = numpy.zeros(parameterMatrix.shape, dtype='int')
   if parameterMatrixCoordinates is None:
-    binEdges = getBinEdges(parameterMatrix.flatten(), **kwargs)
-    discretizedParameterMatrix = numpy.digitize(parameterMatrix, binEdges)
+    binEdges = getBinEdges(parameterMatrix.ravel(), **kwargs)
+    discretizedParameterMatrix = _digitize(parameterMatrix, binEdges)
   else:
-    binEdges = getBinEdges(parameterMatrix[parameterMatrixCoordinates], **kwargs)
-    discretizedParameterMatrix[parameterMatrixCoordinates] = numpy.digitize(parameterMatrix[parameterMatrixCoordinates], binEdges)
+    # Indexing with the coordinates copies the segmented voxels, so only do this once
+    roiValues = parameterMatrix[parameterMatrixCoordinates]
+    binEdges = getBinEdges(roiValues, **kwargs)
+    discretizedParameterMatrix[parameterMatrixCoordinates] = _digitize(roiValues, binEdges)
 
   return discretizedParameterMatrix, binEdges
 
 
+def _digitize(parameterValues, binEdges):
+  """
+  Equivalent to ``numpy.digitize(parameterValues, binEdges)``, but exploits the fact that the bins returned by
+  :py:func:`getBinEdges` are (apart from the topmost edge when using ``binCount``) equally spaced. The bin index is
+  therefore obtained by a rescale of the gray values, instead of a binary search through the edges for each voxel.
+  Rounding errors in the rescale are corrected by comparing each value to the edges of its computed bin, which ensures
+  the result is identical to that of numpy.digitize.
+  """
+  binEdges = numpy.asarray(binEdges)
+  nBins = len(binEdges) - 1
+
+  binIdx = numpy.floor_divide(parameterValues - binEdges[0], binEdges[1] - binEdges[0]).astype('int') + 1
+  numpy.clip(binIdx, 1, nBins, out=binIdx)
+
+  # Correct values that ended up in a neighbouring bin due to floating point errors (or the wider topmost bin)
+  binIdx -= parameterValues < binEdges[binIdx - 1]
+  binIdx += parameterValues >= binEdges[binIdx]
+
+  return binIdx
+
+
 def checkMask(imageNode, maskNode, **kwargs):
   """
   Checks whether the Region of Interest (ROI) defined in the mask size and dimensions match constraints, specified in
@@ -222,8 +250,11 @@ def checkMask(imageNode, maskNode, **kwargs):
 
   logger.debug('Checking mask with label %d', label)
   logger.debug('Calculating bounding box')
-  # Determine bounds
+  # Determine bounds. LabelStatisticsImageFilter is used (instead of the mask-only LabelShapeStatisticsImageFilter), as
+  # it also verifies that image and mask occupy the same physical space. Only the bounding box and count are needed, so
+  # disable the per-label histograms (only needed for the median), which are the most expensive part of the filter.
   lsif = sitk.LabelStatisticsImageFilter()
+  lsif.SetUseHistograms(False)
   try:
     lsif.Execute(imageNode, maskNode)
 
@@ -580,22 +611,31 @@ def normalizeImage(image, **kwargs):
   outliers = kwargs.get('removeOutliers')
 
   logger.debug('Normalizing image with scale %d', scale)
-  image = sitk.Normalize(image)
 
-  if outliers is not None:
-    logger.debug('Removing outliers > %g standard deviations', outliers)
-    imageArr = sitk.GetArrayFromImage(image)
+  if outliers is None:
+    image = sitk.Normalize(image)
+    if scale != 1:
+      image *= scale
+    return image
+
+  # When removing outliers, the image has to be processed as a numpy array. In that case, normalization, outlier removal
+  # and scaling are all performed in place on a single array, which is then converted back to an image once.
+  # Consistent with sitk.Normalize, the image is cast to double and the standard deviation is computed with N - 1 degrees
+  # of freedom. As the mean is subtracted first, the variance is obtained by a single dot product.
+  imageArr = sitk.GetArrayFromImage(image).astype('float64', copy=False)
+  imageArr -= imageArr.mean()
+  imageValues = imageArr.ravel()
+  imageArr /= numpy.sqrt(numpy.dot(imageValues, imageValues) / (imageValues.size - 1))
 
-    imageArr[imageArr > outliers] = outliers
-    imageArr[imageArr < -outliers] = -outliers
+  logger.debug('Removing outliers > %g standard deviations', outliers)
+  numpy.clip(imageArr, -outliers, outliers, out=imageArr)
 
-    newImage = sitk.GetImageFromArray(imageArr)
-    newImage.CopyInformation(image)
-    image = newImage
+  imageArr *= scale
 
-  image *= scale
+  newImage = sitk.GetImageFromArray(imageArr)
+  newImage.CopyInformation(image)
 
-  return image
+  return newImage
 
 
 def resegmentMask(imageNode, maskNode, **kwargs):
@@ -717,6 +757,8 @@ def getLoGImage(inputImage, inputMask, **kwargs):
 
   - sigma: List of floats or integers, must be greater than 0. Filter width (mm) to use for the Gaussian kernel
     (determines coarseness).
+  - logWorkers [2]: Integer, must be greater than 0. Maximum number of sigma values for which the LoG image is computed in
+    parallel. Set to 1 to compute the images sequentially.
 
   .. warning::
     Setting for sigma must be provided. If omitted, no LoG image features are calculated and the function
@@ -748,18 +790,13 @@ def getLoGImage(inputImage, inputMask, **kwargs):
     return
 
   sigmaValues = kwargs.get('sigma', [])
+  maxWorkers = kwargs.get('logWorkers', 2)
 
+  validSigmaValues = []
   for sigma in sigmaValues:
-    logger.info('Computing LoG with sigma %g', sigma)
-
     if sigma > 0.0:
       if numpy.all(size >= numpy.ceil(sigma / spacing) + 1):
-        lrgif = sitk.LaplacianRecursiveGaussianImageFilter()
-        lrgif.SetNormalizeAcrossScale(True)
-        lrgif.SetSigma(sigma)
-        inputImageName = 'log-sigma-%s-mm-3D' % (str(sigma).replace('.', '-'))
-        logger.debug('Yielding %s image', inputImageName)
-        yield lrgif.Execute(inputImage), inputImageName, kwargs
+        validSigmaValues.append(sigma)
       else:
         logger.warning('applyLoG: sigma(%g)/spacing(%s) + 1 must be greater than the size(%s) of the inputImage',
                        sigma,
@@ -768,6 +805,30 @@ def getLoGImage(inputImage, inputMask, **kwargs):
     else:
       logger.warning('applyLoG: sigma must be greater than 0.0: %g', sigma)
 
+  def applyLoG(sigma):
+    logger.info('Computing LoG with sigma %g', sigma)
+    lrgif = sitk.LaplacianRecursiveGaussianImageFilter()
+    lrgif.SetNormalizeAcrossScale(True)
+    lrgif.SetSigma(sigma)
+    inputImageName = 'log-sigma-%s-mm-3D' % (str(sigma).replace('.', '-'))
+    return lrgif.Execute(inputImage), inputImageName
+
+  # ITK releases the GIL while filtering, so the LoG images for multiple sigma values can be computed in parallel.
+  # Images are still yielded in the order of the sigma values. To limit memory usage, a new image is only submitted for
+  # computation when a computed image is yielded, keeping at most maxWorkers images in progress.
+  with concurrent.futures.ThreadPoolExecutor(max_workers=maxWorkers) as executor:
+    sigmaIterator = iter(validSigmaValues)
+    pending = collections.deque([executor.submit(applyLoG, sigma)
+                                 for sigma in itertools.islice(sigmaIterator, maxWorkers)])
+    while len(pending) > 0:
+      logImage, inputImageName = pending.popleft().result()
+      nextSigma = next(sigmaIterator, None)
+      if nextSigma is not None:
+        pending.append(executor.submit(applyLoG, nextSigma))
+
+      logger.debug('Yielding %s image', inputImageName)
+      yield logImage, inputImageName, kwargs
+
 
 def getWaveletImage(inputImage, inputMask, **kwargs):
   """
@@ -807,28 +868,26 @@ def getWaveletImage(inputImage, inputMask, **kwargs):
   if kwargs.get('force2D', False):
     axes.remove(kwargs.get('force2Ddimension', 0))
 
-  approx, ret = _swt3(inputImage, tuple(axes), **kwargs)
+  # _swt3 is a generator, computing each level only when requested. Therefore, only the decompositions of 1 level are
+  # kept in memory, instead of those of all levels.
+  for decompositionName, idx, decompositionArray in _swt3(inputImage, tuple(axes), **kwargs):
+    logger.info('Computing Wavelet %s', decompositionName)
 
-  for idx, wl in enumerate(ret, start=1):
-    for decompositionName, decompositionImage in wl.items():
-      logger.info('Computing Wavelet %s', decompositionName)
-
-      if idx == 1:
-        inputImageName = 'wavelet-%s' % (decompositionName)
-      else:
-        inputImageName = 'wavelet%s-%s' % (idx, decompositionName)
-      logger.debug('Yielding %s image', inputImageName)
-      yield decompositionImage, inputImageName, kwargs
+    decompositionImage = sitk.GetImageFromArray(decompositionArray)
+    decompositionImage.CopyInformation(inputImage)
+    del decompositionArray  # The image holds a copy of the data, so release the array
 
-  if len(ret) == 1:
-    inputImageName = 'wavelet-%s' % ('L' * len(axes))
-  else:
-    inputImageName = 'wavelet%s-%s' % (len(ret), ('L' * len(axes)))
-  logger.debug('Yielding approximation (%s) image', inputImageName)
-  yield approx, inputImageName, kwargs
+    if idx == 1:
+      inputImageName = 'wavelet-%s' % (decompositionName)
+    else:
+      inputImageName = 'wavelet%s-%s' % (idx, decompositionName)
+    logger.debug('Yielding %s image', inputImageName)
+    yield decompositionImage, inputImageName, kwargs
 
 
 def _swt3(inputImage, axes, **kwargs):  # Stationary Wavelet Transform 3D
+  # Generator yielding a tuple of (decomposition name, level index (1-based), cropped decomposition array) for each of the
+  # detail decompositions of each level, followed by the approximation of the last level.
   wavelet = kwargs.get('wavelet', 'coif1')
   level = kwargs.get('level', 1)
   start_level = kwargs.get('start_level', 0)
@@ -841,46 +900,36 @@ def _swt3(inputImage, axes, **kwargs):  # Stationary Wavelet Transform 3D
   # this is of course dependent on the number of dimensions, but the same principle holds
   padding = tuple([(0, 1 if dim % 2 != 0 else 0) for dim in original_shape])
   # padding is necessary because of pywt.swtn (see function Notes)
-  data = matrix.copy()  # creates a modifiable copy of "matrix" and we call it "data"
-  data = numpy.pad(data, padding, 'wrap')  # padding the tuple "padding" previously computed
+  # slices used to crop the decompositions back to the original shape
+  cropping = tuple([slice(None, -1 if dim % 2 != 0 else None) for dim in original_shape])
+  # "matrix" is not modified by pywt.swtn, so no copy is needed when padding is not required (numpy.pad returns a copy)
+  data = matrix
+  if any(pad_after for _, pad_after in padding):
+    data = numpy.pad(data, padding, 'wrap')  # padding the tuple "padding" previously computed
 
   if not isinstance(wavelet, pywt.Wavelet):
     wavelet = pywt.Wavelet(wavelet)
 
   for i in range(0, start_level):  # if start_level = 0 (default) this for loop never gets executed
-    # compute all decompositions and saves them in "dec" dict
-    dec = pywt.swtn(data, wavelet, level=1, start_level=0, axes=axes)[0]
-    # copies in "data" just the "aaa" decomposition (i.e. approximation; No of consecutive 'a's = len(axes))
-    data = dec['a' * len(axes)].copy()
+    # compute all decompositions, but only keep the "aaa" decomposition (i.e. approximation; No of consecutive 'a's =
+    # len(axes)) in "data". The detail decompositions are not referenced and therefore released immediately.
+    data = pywt.swtn(data, wavelet, level=1, start_level=0, axes=axes)[0]['a' * len(axes)]
 
-  ret = []  # initialize empty list
-  for i in range(start_level, start_level + level):
+  for idx in range(1, level + 1):
     # compute the n-dimensional stationary wavelet transform
     dec = pywt.swtn(data, wavelet, level=1, start_level=0, axes=axes)[0]
-    # Copy the approximation into data (approximation in output / input for next levels)
-    data = dec['a' * len(axes)].copy()
-
-    dec_im = {}  # initialize empty dict
-    for decName, decImage in six.iteritems(dec):
-      # Returning the approximiation is done only for the last loop,
-      # and is handled separately below (by building it from `data`)
-      # There for, skip it here
-      if decName == 'a' * len(axes):
-        continue
-      decTemp = decImage.copy()
-      decTemp = decTemp[tuple(slice(None, -1 if dim % 2 != 0 else None) for dim in original_shape)]
-      sitkImage = sitk.GetImageFromArray(decTemp)
-      sitkImage.CopyInformation(inputImage)
-      dec_im[str(decName).replace('a', 'L').replace('d', 'H')] = sitkImage
-      # modifies 'a' with 'L' (Low-pass filter) and 'd' with 'H' (High-pass filter)
-
-    ret.append(dec_im)  # appending all the filtered sitk images (stored in "dec_im") to the "ret" list
+    # Move the approximation into data (approximation in output / input for next levels). pywt allocates a new array
+    # for each decomposition, so no copy is needed. Returning the approximation is done only for the last loop, and is
+    # handled separately below (by yielding it from `data`)
+    data = dec.pop('a' * len(axes))
 
-  data = data[tuple(slice(None, -1 if dim % 2 != 0 else None) for dim in original_shape)]
-  approximation = sitk.GetImageFromArray(data)
-  approximation.CopyInformation(inputImage)
+    for decName in list(dec.keys()):
+      # Remove the decomposition from "dec", so it can be released once the consumer is done with it.
+      # modifies 'a' with 'L' (Low-pass filter) and 'd' with 'H' (High-pass filter)
+      yield str(decName).replace('a', 'L').replace('d', 'H'), idx, dec.pop(decName)[cropping]
 
-  return approximation, ret  # returns the approximation and the detail (ret) coefficients of the stationary wavelet decomposition
+  # yields the approximation, which is named using the index of the last level
+  yield 'L' * len(axes), level, data[cropping]
 
 
 def getSquareImage(inputImage, inputMask, **kwargs):
@@ -899,9 +948,13 @@ def getSquareImage(inputImage, inputMask, **kwargs):
   global logger
 
   im = sitk.GetArrayFromImage(inputImage)
-  im = im.astype('float64')
-  coeff = 1 / numpy.sqrt(numpy.max(numpy.abs(im)))
-  im = (coeff * im) ** 2
+  im = im.astype(numpy.float32, copy=False)
+  im_max = max(im.max(), -im.min())  # max(|x|), without allocating an array for |x|
+  coeff = 1 / numpy.sqrt(im_max)
+  filtered = _evaluate('(coeff * im) ** 2', im=im, coeff=coeff)
+  if filtered is None:
+    filtered = (coeff * im) ** 2
+  im = filtered
   im = sitk.GetImageFromArray(im)
   im.CopyInformation(inputImage)
 
@@ -927,10 +980,18 @@ def getSquareRootImage(inputImage, inputMask, **kwargs):
   global logger
 
   im = sitk.GetArrayFromImage(inputImage)
-  im = im.astype('float64')
-  coeff = numpy.max(numpy.abs(im))
-  im[im > 0] = numpy.sqrt(im[im > 0] * coeff)
-  im[im < 0] = - numpy.sqrt(-im[im < 0] * coeff)
+  im = im.astype(numpy.float32, copy=False)
+  coeff = max(im.max(), -im.min())  # max(|x|), without allocating an array for |x|
+  filtered = _evaluate('where(im < 0, -sqrt(-im * coeff), sqrt(im * coeff))', im=im, coeff=coeff)
+  if filtered is None:
+    # Dense, in-place equivalent of the expression above, avoiding boolean mask indexing
+    sign = numpy.sign(im)
+    numpy.abs(im, out=im)
+    im *= coeff
+    numpy.sqrt(im, out=im)
+    im *= sign
+  else:
+    im = filtered
   im = sitk.GetImageFromArray(im)
   im.CopyInformation(inputImage)
 
@@ -956,11 +1017,22 @@ def getLogarithmImage(inputImage, inputMask, **kwargs):
   global logger
 
   im = sitk.GetArrayFromImage(inputImage)
-  im = im.astype('float64')
-  im_max = numpy.max(numpy.abs(im))
-  im[im > 0] = numpy.log(im[im > 0] + 1)
-  im[im < 0] = - numpy.log(- (im[im < 0] - 1))
-  im = im * (im_max / numpy.max(numpy.abs(im)))
+  im = im.astype(numpy.float32, copy=False)
+  im_max = max(im.max(), -im.min())  # max(|x|), without allocating an array for |x|
+  # log(|x| + 1) increases monotonically with |x|, so the maximum of the transformed image is log(max(|x|) + 1) and the
+  # coefficient can be computed without an additional pass over the transformed image
+  coeff = im_max / numpy.log(im_max + 1)
+  filtered = _evaluate('coeff * where(im < 0, -log(1 - im), log(im + 1))', im=im, coeff=coeff)
+  if filtered is None:
+    # Dense, in-place equivalent of the expression above, avoiding boolean mask indexing
+    sign = numpy.sign(im)
+    numpy.abs(im, out=im)
+    im += 1
+    numpy.log(im, out=im)
+    im *= sign
+    im *= coeff
+  else:
+    im = filtered
   im = sitk.GetImageFromArray(im)
   im.CopyInformation(inputImage)
 
@@ -983,10 +1055,13 @@ def getExponentialImage(inputImage, inputMask, **kwargs):
   global logger
 
   im = sitk.GetArrayFromImage(inputImage)
-  im = im.astype('float64')
-  im_max = numpy.max(numpy.abs(im))
+  im = im.astype(numpy.float32, copy=False)
+  im_max = max(im.max(), -im.min())  # max(|x|), without allocating an array for |x|
   coeff = numpy.log(im_max) / im_max
-  im = numpy.exp(coeff * im)
+  filtered = _evaluate('exp(coeff * im)', im=im, coeff=coeff)
+  if filtered is None:
+    filtered = numpy.exp(coeff * im)
+  im = filtered
   im = sitk.GetImageFromArray(im)
   im.CopyInformation(inputImage)
 
@@ -994,6 +1069,21 @@ def getExponentialImage(inputImage, inputMask, **kwargs):
   yield im, 'exponential', kwargs
 
 
+def _evaluate(expression, **arrays):
+  """
+  Evaluate an element-wise ``expression`` on the passed arrays (and scalars) using the optional package ``numexpr``,
+  which computes the entire expression in a single (multithreaded) pass over the data, without allocating temporary
+  arrays for intermediate results. Returns ``None`` if ``numexpr`` is not available, in which case the caller should
+  fall back to the equivalent numpy implementation.
+  """
+  try:
+    import numexpr
+  except ImportError:
+    return None
+
+  return numexpr.evaluate(expression, local_dict=arrays)
+
+
 def getGradientImage(inputImage, inputMask, **kwargs):
   r"""
   Compute and return the Gradient Magnitude in the image.